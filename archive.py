@@ -0,0 +1,268 @@
+import argparse
+import bisect
+import datetime
+import importlib.util
+import mmap
+import os
+import struct
+import sys
+import threading
+
+
+# An append-only archive of every forecast we fetch and every reading from the
+# outdoor sensor, so comparing forecasts to what actually happened doesn't have
+# to be done by hand any more.
+#
+# Each archive is a file of fixed size, little endian records, whose first field
+# is a time in seconds since the epoch.  Records are appended in time order, so
+# a range of times is a contiguous range of records, which we find by binary
+# search.  Alongside is a sparse index, NAME.idx, with the time of every
+# INDEX_INTERVAL'th record, so a search only has to touch one block of the
+# (memory mapped) data file.
+#
+# This module is also a command line tool, see main() at the bottom.
+
+# Fetch time, lead time (seconds from fetch to the start of the forecast hour;
+# slightly negative for the current hour), temperature F, precipitation
+# probability 0 - 1.
+FORECAST_RECORD = struct.Struct("<Iiff")
+
+# Time, temperature F, humidity %.
+OBSERVATION_RECORD = struct.Struct("<Iff")
+
+INDEX_RECORD = struct.Struct("<I")
+INDEX_INTERVAL = 1024
+
+FORECASTS_FILE = "forecasts.bin"
+OBSERVATIONS_FILE = "observations.bin"
+
+
+class Archive:
+    def __init__(self, path, record):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.record = record
+        self.lock = threading.Lock()
+
+        self.file = open(path, "ab", buffering=0)
+        size = os.fstat(self.file.fileno()).st_size
+        if size % record.size:
+            # We died part way through writing a record.
+            size -= size % record.size
+            self.file.truncate(size)
+        self.count = size // record.size
+        if self.count:
+            with open(path, "rb") as f:
+                f.seek(size - record.size)
+                self.last_time = record.unpack(f.read(record.size))[0]
+        else:
+            self.last_time = 0
+
+        self.index = read_index(self.index_path)
+        expected = (self.count + INDEX_INTERVAL - 1) // INDEX_INTERVAL
+        if len(self.index) != expected:
+            self.index = [
+                record.unpack_from(block)[0]
+                for block in ArchiveReader(path, record).index_blocks()
+            ]
+            with open(self.index_path, "wb") as f:
+                f.write(b"".join(INDEX_RECORD.pack(t) for t in self.index))
+        self.index_file = open(self.index_path, "ab", buffering=0)
+
+    # records is a list of tuples, in time order, matching self.record.  If the
+    # clock has gone backwards, they're stamped with the time of the newest
+    # record instead, since searching depends on the file being in time order.
+    def append(self, records):
+        if not records:
+            return
+        with self.lock:
+            if min(r[0] for r in records) < self.last_time:
+                stamped = []
+                for r in records:
+                    self.last_time = max(r[0], self.last_time)
+                    stamped.append((self.last_time,) + tuple(r[1:]))
+                records = stamped
+            self.last_time = records[-1][0]
+            self.file.write(b"".join(self.record.pack(*r) for r in records))
+            new_index = []
+            for i, r in enumerate(records, self.count):
+                if i % INDEX_INTERVAL == 0:
+                    new_index.append(r[0])
+            if new_index:
+                self.index_file.write(b"".join(INDEX_RECORD.pack(t) for t in new_index))
+                self.index += new_index
+            self.count += len(records)
+
+    def close(self):
+        self.file.close()
+        self.index_file.close()
+
+
+def read_index(path):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    data = data[: len(data) - len(data) % INDEX_RECORD.size]
+    return [t for (t,) in INDEX_RECORD.iter_unpack(data)]
+
+
+# Read only, memory mapped view of an archive.  Queries return memoryviews of
+# the mapping, so nothing is copied or turned into Python objects until the
+# caller wants it to be.  The mapping covers the file as it was when the reader
+# was opened; open a new reader to see newer records.
+class ArchiveReader:
+    def __init__(self, path, record):
+        self.record = record
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            size -= size % record.size
+            if size:
+                self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.map)
+            else:
+                self.map = None
+                self.view = memoryview(b"")
+        self.count = size // record.size
+        self.index = read_index(path + ".idx")[
+            : (self.count + INDEX_INTERVAL - 1) // INDEX_INTERVAL
+        ]
+
+    def index_blocks(self):
+        for i in range(0, self.count, INDEX_INTERVAL):
+            yield self.view[i * self.record.size : (i + 1) * self.record.size]
+
+    def time_at(self, i):
+        return self.record.unpack_from(self.view, i * self.record.size)[0]
+
+    # Index of the first record with time >= t.
+    def search(self, t):
+        # The sparse index narrows it down to one block, assuming it's up to
+        # date; if not, we just search more of the file.
+        block = bisect.bisect_left(self.index, t)
+        lo = max(0, (block - 1) * INDEX_INTERVAL)
+        hi = self.count if block >= len(self.index) else block * INDEX_INTERVAL
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time_at(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Records with start <= time < end, as a memoryview of the raw records.
+    def range(self, start=None, end=None):
+        first = 0 if start is None else self.search(start)
+        last = self.count if end is None else self.search(end)
+        return self.view[first * self.record.size : max(first, last) * self.record.size]
+
+    def records(self, start=None, end=None):
+        return self.record.iter_unpack(self.range(start, end))
+
+
+def open_archives(directory):
+    os.makedirs(directory, exist_ok=True)
+    return (
+        Archive(os.path.join(directory, FORECASTS_FILE), FORECAST_RECORD),
+        Archive(os.path.join(directory, OBSERVATIONS_FILE), OBSERVATION_RECORD),
+    )
+
+
+# Forecast error by lead time, i.e. how far ahead the forecast was made.  The
+# "actual" temperature for an hour is the mean of the sensor's readings during
+# that hour.  Everything is done with numpy on the memory mapped files, so
+# months of data take seconds, not minutes.
+def forecast_error(directory, start=None, end=None, max_lead_hours=7 * 24):
+    import numpy as np
+
+    forecasts_reader = ArchiveReader(
+        os.path.join(directory, FORECASTS_FILE), FORECAST_RECORD
+    )
+    observations_reader = ArchiveReader(
+        os.path.join(directory, OBSERVATIONS_FILE), OBSERVATION_RECORD
+    )
+    forecasts = np.frombuffer(
+        forecasts_reader.range(start, end),
+        dtype=np.dtype(
+            [("fetched", "<u4"), ("lead", "<i4"), ("temp", "<f4"), ("precip", "<f4")]
+        ),
+    )
+    # Forecasts made near the end of the range are about hours after it.
+    observations = np.frombuffer(
+        observations_reader.range(
+            start, None if end is None else end + max_lead_hours * 3600
+        ),
+        dtype=np.dtype([("time", "<u4"), ("temp", "<f4"), ("humidity", "<f4")]),
+    )
+    if len(forecasts) == 0 or len(observations) == 0:
+        return []
+
+    first_hour = int(observations["time"][0]) // 3600
+    observed_hour = observations["time"].astype(np.int64) // 3600 - first_hour
+    hourly_sum = np.bincount(observed_hour, weights=observations["temp"])
+    hourly_count = np.bincount(observed_hour)
+
+    target_hour = (
+        forecasts["fetched"].astype(np.int64) + forecasts["lead"]
+    ) // 3600 - first_hour
+    lead_hour = forecasts["lead"].astype(np.int64) // 3600
+    usable = (
+        (target_hour >= 0)
+        & (target_hour < len(hourly_count))
+        & (lead_hour >= 0)
+        & (lead_hour < max_lead_hours)
+    )
+    # Hours where the sensor didn't report, e.g. while changing its batteries.
+    usable[usable] = hourly_count[target_hour[usable]] > 0
+    target_hour = target_hour[usable]
+    lead_hour = lead_hour[usable]
+
+    error = (
+        forecasts["temp"][usable] - hourly_sum[target_hour] / hourly_count[target_hour]
+    )
+    count = np.bincount(lead_hour, minlength=max_lead_hours)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        bias = np.bincount(lead_hour, weights=error, minlength=max_lead_hours) / count
+        mae = (
+            np.bincount(lead_hour, weights=np.abs(error), minlength=max_lead_hours)
+            / count
+        )
+        rmse = np.sqrt(
+            np.bincount(lead_hour, weights=error * error, minlength=max_lead_hours)
+            / count
+        )
+    return [
+        (hour, int(count[hour]), float(bias[hour]), float(mae[hour]), float(rmse[hour]))
+        for hour in range(max_lead_hours)
+        if count[hour]
+    ]
+
+
+def parse_date(string):
+    return int(datetime.datetime.fromisoformat(string).timestamp())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="archive",
+        description="Compare archived forecasts to archived sensor readings",
+    )
+    parser.add_argument("directory", help="the --archive-dir given to weather.py")
+    parser.add_argument("--start", type=parse_date, help="e.g. 2024-01-31")
+    parser.add_argument("--end", type=parse_date)
+    parser.add_argument("--max-lead-hours", type=int, default=7 * 24)
+    args = parser.parse_args()
+
+    if importlib.util.find_spec("numpy") is None:
+        print("The forecast error tool needs numpy.", file=sys.stderr)
+        sys.exit(1)
+
+    rows = forecast_error(args.directory, args.start, args.end, args.max_lead_hours)
+    print("lead_hours      n    bias     mae    rmse")
+    for hour, count, bias, mae, rmse in rows:
+        print(f"{hour:10} {count:6} {bias:+7.2f} {mae:7.2f} {rmse:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
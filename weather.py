@@ -1,9 +1,12 @@
 import urllib.request
+import urllib.parse
 import json
+import io
+import re
 from datetime import timedelta
 import datetime
 import time
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 import math
 import sys
 from zoneinfo import ZoneInfo
@@ -17,6 +20,23 @@ import time
 import argparse
 import signal
 import traceback
+import collections
+import atexit
+import logging
+import logging.handlers
+import queue
+import gc
+import ipaddress
+import resource
+import struct
+import tracemalloc
+import bisect
+import gzip
+import zlib
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+
+import archive
 
 
 # The screen is 800 x 480.
@@ -74,15 +94,26 @@ AFTERNOON_GREY = (PRECIPITATION_GREY + 256) // 2
 
 AFTERNOON_PRECIPITATION_GREY = PRECIPITATION_GREY * AFTERNOON_GREY // 255
 
-TEMPERATURE_BOX = (800 - 256, 25, 800 - 128, 25 + 128)
-ICON_BOX = (800 - 128, 25, 800, 25 + 128)
+# The screen is laid out in these units, which are pixels on the original
+# 800x480 panel, then scaled to whatever size panel asks for it.  See Layout.
+LAYOUT_WIDTH = 800
+LAYOUT_HEIGHT = 480
+LAYOUT_SIZE = (LAYOUT_WIDTH, LAYOUT_HEIGHT)
+
+TEMPERATURE_BOX = (LAYOUT_WIDTH - 256, 25, LAYOUT_WIDTH - 128, 25 + 128)
+ICON_BOX = (LAYOUT_WIDTH - 128, 25, LAYOUT_WIDTH, 25 + 128)
 
 # Aligned to the bottom right.  Width equals sky icon plus temp: 256. For
 # height, subtract sky icon = temp = 128, plus a 25 pixel border above those.
 
-MORNING_CLOTHING_BOX = (800 - 256, 128 + 25, 800 - 128, 480)
-AFTERNOON_CLOTHING_BOX = (800 - 128, 128 + 25, 800, 480)
-CLOTHING_BOX = (800 - (128 + 64), 128 + 25, 800 - 64, 480)
+MORNING_CLOTHING_BOX = (
+    LAYOUT_WIDTH - 256,
+    128 + 25,
+    LAYOUT_WIDTH - 128,
+    LAYOUT_HEIGHT,
+)
+AFTERNOON_CLOTHING_BOX = (LAYOUT_WIDTH - 128, 128 + 25, LAYOUT_WIDTH, LAYOUT_HEIGHT)
+CLOTHING_BOX = (LAYOUT_WIDTH - (128 + 64), 128 + 25, LAYOUT_WIDTH - 64, LAYOUT_HEIGHT)
 
 GAP_BETWEEN_GRAPH_AND_LABELS = 10
 
@@ -94,7 +125,18 @@ GAP_BETWEEN_GRAPH_AND_LABELS = 10
 RTL_433_MODEL = "LaCrosse-TX141THBv2"
 RTL_433_CHANNEL = 0
 
+# Once the last sensor reading is this old, show how many minutes old it is
+# instead of the temperature, and after SENSOR_GIVE_UP_SEC, just "--".
+SENSOR_STALE_SEC = 5 * 60
+SENSOR_GIVE_UP_SEC = 100 * 60
+
+# After failing to get a forecast, try again this soon, then back off; see
+# PollingScheduler.retry_interval().
+FORECAST_RETRY_SEC = 30
 
+
+# This deliberately prints straight to stdout rather than going through log(),
+# since the signal could arrive while this thread holds the log queue's lock.
 def print_stack(sig, frame):
     print("**********  In signal handler, printing stack frame.  **********")
     print("".join(traceback.format_stack(frame)))
@@ -122,8 +164,23 @@ def get_api_key(name):
     return value
 
 
-# TOMORROW_IO_API_KEY = get_api_key("TOMORROW_IO_API_KEY")
-VISUAL_CROSSING_API_KEY = get_api_key("VISUAL_CROSSING_API_KEY")
+# Naive times are local.
+def parse_local_time(string):
+    return datetime.datetime.fromisoformat(string).astimezone()
+
+
+# Returns None for anything that isn't WIDTHxHEIGHT.
+def parse_panel_size(string):
+    match = re.fullmatch(r"(\d{2,4})x(\d{2,4})", string)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def panel_size_argument(string):
+    size = parse_panel_size(string)
+    if size is None:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, not {string!r}")
+    return size
+
 
 parser = argparse.ArgumentParser(
     prog="weather",
@@ -131,12 +188,261 @@ parser = argparse.ArgumentParser(
 )
 parser.add_argument("latitude", type=float)
 parser.add_argument("longitude", type=float)
+parser.add_argument(
+    "--location",
+    action="append",
+    default=[],
+    metavar="NAME=LATITUDE,LONGITUDE",
+    help="another location to serve, as /weather.bmp?location=NAME; can be repeated, "
+    "NAME can't be home",
+)
+parser.add_argument(
+    "--tracemalloc",
+    type=int,
+    default=0,
+    metavar="FRAMES",
+    help="trace Python allocations, keeping this many stack frames, for /debug/memory",
+)
+parser.add_argument(
+    "--archive-dir",
+    help="append every forecast and sensor reading to archives in this directory",
+)
+parser.add_argument(
+    "--log-level",
+    default="INFO",
+    choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+    help="DEBUG adds timings and every line from rtl_433",
+)
+parser.add_argument(
+    "--shared-sensor",
+    choices=["publish", "subscribe"],
+    help="publish the outdoor sensor's readings in shared memory, or read them from"
+    " there instead of running rtl_433, for running several processes on one box",
+)
+parser.add_argument("--shared-sensor-name", default="weather_sensor")
+parser.add_argument(
+    "--daily-request-budget",
+    type=int,
+    # The old fixed rate of once every 2.5 minutes.
+    default=576,
+    help="forecast API requests to spread over each day; the count survives"
+    " restarts with --archive-dir, otherwise it starts over with each process",
+)
+parser.add_argument(
+    "--panel-size",
+    action="append",
+    default=[],
+    type=panel_size_argument,
+    metavar="WIDTHxHEIGHT",
+    help="another panel size to serve, as /weather.bmp?size=WIDTHxHEIGHT, and to"
+    " --batch-render; can be repeated",
+)
+parser.add_argument(
+    "--record-forecasts",
+    metavar="DIR",
+    help="save every forecast for home, as fetched, in this directory, for"
+    " --batch-render",
+)
+batch = parser.add_argument_group(
+    "batch rendering",
+    "Draw the dashboard at simulated times from recorded forecasts and, if"
+    " --archive-dir is given, archived sensor readings, instead of serving.",
+)
+batch.add_argument("--batch-render", metavar="OUT_DIR", help="write frames here")
+batch.add_argument(
+    "--batch-forecasts", metavar="DIR", help="a --record-forecasts directory"
+)
+batch.add_argument(
+    "--batch-start",
+    type=parse_local_time,
+    help="e.g. 2024-01-31T06:00; default the first recorded forecast",
+)
+batch.add_argument(
+    "--batch-end", type=parse_local_time, help="default the last recorded forecast"
+)
+batch.add_argument("--batch-step", type=float, default=1, metavar="MINUTES")
+batch.add_argument(
+    "--batch-compare",
+    metavar="REF_DIR",
+    help="count the pixels that differ from the frames in this directory, e.g."
+    " an earlier --batch-render, and write OUT_DIR/diff.csv",
+)
+batch.add_argument("--batch-workers", type=int, default=os.cpu_count())
 args = parser.parse_args()
 
+# The first is the default.
+panel_sizes = [LAYOUT_SIZE] + [
+    size for size in dict.fromkeys(args.panel_size) if size != LAYOUT_SIZE
+]
+
+if args.batch_render:
+    if not args.batch_forecasts:
+        parser.error("--batch-render needs --batch-forecasts")
+    if args.shared_sensor:
+        parser.error("--batch-render reads the sensor from --archive-dir")
+
+# TOMORROW_IO_API_KEY = get_api_key("TOMORROW_IO_API_KEY")
+VISUAL_CROSSING_API_KEY = (
+    None if args.batch_render else get_api_key("VISUAL_CROSSING_API_KEY")
+)
+
+if args.tracemalloc:
+    tracemalloc.start(args.tracemalloc)
+
+
+# Counters for things that happen too often to print every time, like requests
+# from internet scanners.  See /debug/stats.
+class Counters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+stats = Counters()
+
+
+# Logging.  Messages are an event name plus key=value fields, e.g.
+#
+#   2024-01-31 07:02:11,417 INFO frame fmt=rle bytes=2811 sec=0.004
+#
+# log() only puts the record on a queue; a background thread formats it and
+# does the (possibly slow, on an SD card) write, so none of that happens while
+# a display is waiting for its image.  Chatty events can be sampled, see
+# LOG_SAMPLE_EVERY.
+
+# Log only one in this many of these events.
+LOG_SAMPLE_EVERY = {
+    "rtl_433_line": 10,
+}
+
+# If the writer falls this far behind, drop messages rather than use up memory.
+LOG_QUEUE_SIZE = 10000
+
+
+def format_log_value(value):
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    value = str(value)
+    if not value or any(c.isspace() or c in '"=' for c in value):
+        return json.dumps(value)
+    return value
+
+
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record):
+        text = " ".join(
+            [self.formatTime(record), record.levelname, record.msg]
+            + [
+                f"{name}={format_log_value(value)}"
+                for name, value in getattr(record, "fields", {}).items()
+            ]
+        )
+        if record.exc_text:
+            text += "\n" + record.exc_text
+        return text
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample_every):
+        super().__init__()
+        self.sample_every = sample_every
+        self.seen = collections.Counter()
+
+    def filter(self, record):
+        every = self.sample_every.get(record.msg)
+        if every is None:
+            return True
+        # Racy, but the worst case is logging one more or one fewer.
+        seen = self.seen[record.msg]
+        self.seen[record.msg] = seen + 1
+        return seen % every == 0
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # QueueHandler would format the whole message here, on the caller's
+        # thread.  Only tracebacks need doing now, while the frames still exist.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            stats.count("log_messages_dropped")
+
+
+logger = logging.getLogger("weather")
+logger.setLevel(args.log_level)
+logger.propagate = False
+logger.addFilter(SamplingFilter(LOG_SAMPLE_EVERY))
+log_output = logging.StreamHandler(sys.stdout)
+log_output.setFormatter(KeyValueFormatter())
+if args.batch_render:
+    # Batch rendering forks its workers, and threads don't survive a fork, so
+    # the parent doesn't start any.  It doesn't log much, so write directly.
+    logger.addHandler(log_output)
+else:
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    logger.addHandler(BackgroundQueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, log_output)
+    log_listener.start()
+    # Write out whatever's still queued when we exit.
+    atexit.register(log_listener.stop)
+
+
+def log(event, level=logging.INFO, exc_info=False, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+
 LATITUDE = args.latitude
 LONGITUDE = args.longitude
 
 
+class Location:
+    def __init__(self, name, latitude, longitude):
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+
+
+# The location given by the latitude and longitude arguments, which is where the
+# outdoor sensor is.
+HOME = "home"
+
+
+def parse_locations(home_latitude, home_longitude, location_args):
+    locations = {HOME: Location(HOME, home_latitude, home_longitude)}
+    for arg in location_args:
+        try:
+            name, coordinates = arg.split("=", 1)
+            latitude, longitude = (float(x) for x in coordinates.split(","))
+        except ValueError:
+            parser.error(f"--location {arg}: expected NAME=LATITUDE,LONGITUDE")
+        # The home location comes from the positional arguments, and it's the
+        # only one with the outdoor sensor.
+        if name == HOME:
+            parser.error(f"--location {arg}: {HOME} is the LATITUDE LONGITUDE location")
+        if name in locations:
+            parser.error(f"--location {arg}: {name} given more than once")
+        locations[name] = Location(name, latitude, longitude)
+    return locations
+
+
+locations = parse_locations(LATITUDE, LONGITUDE, args.location)
+
+
 def scale_to_fit(image, box):
     width = box[2] - box[0]
     height = box[3] - box[1]
@@ -146,44 +452,219 @@ def scale_to_fit(image, box):
     )
 
 
+SensorReading = collections.namedtuple(
+    "SensorReading", ["time", "temperature", "humidity", "battery_ok"]
+)
+
+NO_SENSOR_READING = SensorReading(datetime.datetime(2000, 1, 1), 999, 999, True)
+
+
+def reading_changes_screen(old, new):
+    return (
+        round(new.temperature) != round(old.temperature)
+        or temperature_band(new.temperature) != temperature_band(old.temperature)
+        or new.battery_ok != old.battery_ok
+        # We were showing how old the reading was.
+        or (new.time - old.time).total_seconds() >= SENSOR_STALE_SEC
+    )
+
+
 # Used to communicate between the main thread and the thread running the RTL_433
 # program, which receives temperature (and humidity, not used) from the LaCrosse
 # outdoor temperature sensor.
 class LocalWeather:
     def __init__(self):
-        self.lock = threading.Lock()
-        self.time = datetime.datetime(2000, 1, 1)
-        self.temperature = 999
-        self.humidity = 999
-        self.battery_ok = True
+        # A reading is never modified, only replaced, so readers can take a
+        # consistent snapshot without a lock.
+        self.reading = NO_SENSOR_READING
+        # Called when a new reading changes what's on the screen.
+        self.on_change = None
+
+    def snapshot(self):
+        return self.reading
 
     def set(self, time, temperature, humidity, battery_ok):
-        with self.lock:
-            self.time = time
-            self.temperature = temperature
-            self.humidity = humidity
-            self.battery_ok = battery_ok
+        old = self.reading
+        self.reading = SensorReading(time, temperature, humidity, battery_ok)
+        if reading_changes_screen(old, self.reading) and self.on_change is not None:
+            self.on_change()
 
 
-local_weather = LocalWeather()
+# The rtl_433 dongle can only be used by one process, so when several processes
+# on the box want the outdoor temperature (say, a few servers, or render
+# workers), one of them runs rtl_433 and publishes each reading in a small
+# shared memory segment, and the rest read it from there.
+#
+# The segment is a sequence number followed by the reading.  The writer makes
+# the sequence number odd while it's writing and even when it's done, so a
+# reader that sees the same even number before and after reading the fields
+# knows it got a consistent reading, without any locks (a "seqlock").  The
+# sequence number is a native, aligned 32 bit int accessed through a memoryview,
+# so it's read and written in one go; struct would do it a byte at a time, and a
+# reader could see half an update.
+#
+# That relies on the other process seeing our stores in the order we made
+# them, which x86 guarantees but ARM (e.g. a Raspberry Pi) doesn't, and Python
+# gives us no way to ask for a barrier.  So there's also a CRC32 of the fields
+# after the sequence number, and a reader that gets a reading that doesn't
+# match it tries again.
+SHARED_SENSOR_CHECKSUM = struct.Struct("<I")
+SHARED_SENSOR_CHECKSUM_OFFSET = 4
+SHARED_SENSOR_FIELDS_OFFSET = 8
+SHARED_SENSOR_FIELDS = struct.Struct("<ddd?")
+SHARED_SENSOR_SIZE = SHARED_SENSOR_FIELDS_OFFSET + SHARED_SENSOR_FIELDS.size
+
+# How often subscribers check for a new reading.
+SHARED_SENSOR_POLL_SEC = 2
+SHARED_SENSOR_READ_TRIES = 1000
+
+
+# Whoever starts first, publisher or subscriber, creates the segment.  It
+# starts out all zeros, and a sequence number of 0 means nothing's been
+# published yet, so a subscriber started before the publisher just shows no
+# reading until there is one.
+def open_shared_memory(name):
+    try:
+        shm = shared_memory.SharedMemory(name, create=True, size=SHARED_SENSOR_SIZE)
+        # Never unlink it, so subscribers outlive a restart of the publisher,
+        # and vice versa.
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+    except FileExistsError:
+        # Someone else got there first, or it's left over from the last time
+        # we ran.
+        pass
+    try:
+        shm = shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13, the resource tracker unlinks every segment a
+        # process opened when it exits, even ones it didn't create.
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class SharedLocalWeather(LocalWeather):
+    def __init__(self, name, publish):
+        super().__init__()
+        self.shm = open_shared_memory(name)
+        if self.shm.size < SHARED_SENSOR_SIZE:
+            raise Exception(f"Shared memory segment {name} is too small")
+        self.sequence = self.shm.buf[:4].cast("I")
+        # SharedMemory can't close while self.sequence is using its buffer.
+        atexit.register(self.sequence.release)
+        self.publish = publish
+        self.reading = self.read()
+        if not publish:
+            threading.Thread(
+                target=self.watch, name="shared_sensor_watch", daemon=True
+            ).start()
+
+    def read(self):
+        for _ in range(SHARED_SENSOR_READ_TRIES):
+            before = self.sequence[0]
+            if before & 1 == 0:
+                fields = bytes(
+                    self.shm.buf[SHARED_SENSOR_FIELDS_OFFSET:SHARED_SENSOR_SIZE]
+                )
+                (checksum,) = SHARED_SENSOR_CHECKSUM.unpack_from(
+                    self.shm.buf, SHARED_SENSOR_CHECKSUM_OFFSET
+                )
+                if self.sequence[0] == before and (
+                    before == 0 or checksum == zlib.crc32(fields)
+                ):
+                    break
+            # The publisher is part way through writing; it'll be done in a
+            # moment.
+            time.sleep(0)
+        else:
+            # Or it died part way through.  It'll fix things up when it comes
+            # back, see set().
+            return self.reading
+        if before == 0:
+            return NO_SENSOR_READING
+        time_stamp, temperature, humidity, battery_ok = SHARED_SENSOR_FIELDS.unpack(
+            fields
+        )
+        return SensorReading(
+            datetime.datetime.fromtimestamp(time_stamp),
+            temperature,
+            humidity,
+            battery_ok,
+        )
+
+    def set(self, time, temperature, humidity, battery_ok):
+        # | 1 in case a previous publisher died part way through a write.
+        sequence = self.sequence[0] | 1
+        self.sequence[0] = sequence
+        fields = SHARED_SENSOR_FIELDS.pack(
+            time.timestamp(), temperature, humidity, battery_ok
+        )
+        self.shm.buf[SHARED_SENSOR_FIELDS_OFFSET:SHARED_SENSOR_SIZE] = fields
+        SHARED_SENSOR_CHECKSUM.pack_into(
+            self.shm.buf, SHARED_SENSOR_CHECKSUM_OFFSET, zlib.crc32(fields)
+        )
+        # Skip 0, which means nothing's been written yet.
+        self.sequence[0] = (sequence + 1) & 0xFFFFFFFF or 2
+        super().set(time, temperature, humidity, battery_ok)
+
+    def snapshot(self):
+        if self.publish:
+            return self.reading
+        return self.read()
+
+    def watch(self):
+        while True:
+            time.sleep(SHARED_SENSOR_POLL_SEC)
+            old = self.reading
+            self.reading = self.read()
+            if reading_changes_screen(old, self.reading) and self.on_change:
+                self.on_change()
+
+
+if args.shared_sensor:
+    local_weather = SharedLocalWeather(
+        args.shared_sensor_name, args.shared_sensor == "publish"
+    )
+else:
+    local_weather = LocalWeather()
+
+
+if args.archive_dir and not args.batch_render:
+    forecast_archive, observation_archive = archive.open_archives(args.archive_dir)
+else:
+    forecast_archive = observation_archive = None
+
+if args.record_forecasts:
+    os.makedirs(args.record_forecasts, exist_ok=True)
+
+
+def archive_records(which, records):
+    if which is None:
+        return
+    try:
+        which.append(records)
+    except OSError as e:
+        # Don't let a full SD card take the display down with it.
+        log("archive_error", logging.ERROR, path=which.path, error=e)
 
 
 def rtl_433_thread(local_weather: LocalWeather):
     try:
         rtl_433_loop(local_weather)
-    except Exception as e:
-        print(f'***** RTL 433 thread had exception "{str(e)}"')
+    except Exception:
+        log("rtl_433_exception", logging.ERROR, exc_info=True)
     except:
-        print(f"***** Caught unknown exception in RTL 433 thread! {sys.exc_info()[0]}")
+        log("rtl_433_exception", logging.ERROR, type=sys.exc_info()[0])
 
-    print("*****  rtl_433 thread ended!", flush=True)
+    log("rtl_433_ended", logging.ERROR)
     sys.exit(2)
 
 
 def rtl_433_loop(local_weather: LocalWeather):
     subprocess.run(["pkill", "rtl_433"])
     while subprocess.run(["pgrep", "rtl_433"]).returncode == 0:
-        print("***** rtl_433 still running, sleeping.")
+        log("rtl_433_still_running", logging.WARNING)
         time.sleep(1)
 
     proc = subprocess.Popen(
@@ -195,7 +676,7 @@ def rtl_433_loop(local_weather: LocalWeather):
     )
     for line in proc.stdout:
         line = line.strip()
-        print(line, flush=True)
+        log("rtl_433_line", logging.DEBUG, line=line)
         parsed = json.loads(line)
         if (
             parsed["model"] == RTL_433_MODEL
@@ -203,18 +684,39 @@ def rtl_433_loop(local_weather: LocalWeather):
             # and parsed["id"] == RTL_433_ID
             and parsed["channel"] == RTL_433_CHANNEL
         ):
+            reading_time = parse_datetime(parsed["time"])
+            temperature = parsed["temperature_C"] * 1.8 + 32
             local_weather.set(
-                parse_datetime(parsed["time"]),
-                parsed["temperature_C"] * 1.8 + 32,
+                reading_time,
+                temperature,
                 parsed["humidity"],
                 parsed["battery_ok"] == 1,
             )
+            archive_records(
+                observation_archive,
+                # rtl_433's time is naive local time, which goes back an hour
+                # when daylight saving ends, and the archive has to be in time
+                # order.
+                [(int(time.time()), temperature, parsed["humidity"])],
+            )
 
 
-have_rtl_433 = shutil.which("rtl_433")
-print(f"{have_rtl_433=}")
+if args.batch_render:
+    # Readings come from the archive, if there is one.
+    have_rtl_433 = None
+    have_sensor = bool(args.archive_dir)
+elif args.shared_sensor == "subscribe":
+    # Another process runs rtl_433.
+    have_rtl_433 = None
+    have_sensor = True
+else:
+    have_rtl_433 = shutil.which("rtl_433")
+    have_sensor = bool(have_rtl_433)
+log("startup", have_rtl_433=have_rtl_433, shared_sensor=args.shared_sensor)
 if have_rtl_433:
-    thread = threading.Thread(target=rtl_433_thread, args=(local_weather,))
+    thread = threading.Thread(
+        target=rtl_433_thread, args=(local_weather,), name="rtl_433"
+    )
     thread.start()
 
 
@@ -253,8 +755,26 @@ class Forecast:
         self.is_raining = is_raining
 
 
+# Icons scaled to fit a box of a given size in pixels, by (fname, width,
+# height).  Each panel size needs its own, but only a few sizes of box, so this
+# stays small.  The full size icons are big, so we don't keep them around.
+scaled_icons = {}
+
+
+def scaled_icon(fname, width, height):
+    key = (fname, width, height)
+    icon = scaled_icons.get(key)
+    if icon is None:
+        icon = scale_to_fit(Image.open(fname).convert("L"), (0, 0, width, height))
+        scaled_icons[key] = icon
+    return icon
+
+
+# Layouts refer to icons by file name.  Loads the icon for the default panel
+# size, so a missing file is found at startup.
 def load_icon(fname, box):
-    return scale_to_fit(Image.open(fname).convert("L"), box)
+    scaled_icon(fname, box[2] - box[0], box[3] - box[1])
+    return fname
 
 
 class TemperatureBand(Enum):
@@ -277,19 +797,23 @@ clothing_raining = {
 }
 
 
+def temperature_band(temperature):
+    if temperature < 44.5:
+        return TemperatureBand.COLD
+    elif temperature < 70:
+        return TemperatureBand.COOL
+    elif temperature < 79.5:
+        return TemperatureBand.WARM
+    else:
+        return TemperatureBand.HOT
+
+
 def get_clothing(temperature, is_raining):
     # Should this take into account sunny vs cloudy?  Direct sun will definitely
     # feel warmer than the measured or forecast temperatures, which are always
     # in the shade.
     clothing = clothing_raining if is_raining else clothing_not_raining
-    if temperature < 44.5:
-        return clothing[TemperatureBand.COLD]
-    elif temperature < 70:
-        return clothing[TemperatureBand.COOL]
-    elif temperature < 79.5:
-        return clothing[TemperatureBand.WARM]
-    else:
-        return clothing[TemperatureBand.HOT]
+    return clothing[temperature_band(temperature)]
 
 
 class Cloudiness(Enum):
@@ -373,42 +897,413 @@ def fetch_json(url):
     with urllib.request.urlopen(url, timeout=15) as response:
         fetch_end = time.monotonic()
         if response.status == 200:
-            # Read the response data and decode it as JSON
-            result = json.loads(response.read().decode("utf-8"))
+            # Read the response data and decode it as JSON.  json.loads() takes
+            # the UTF-8 bytes directly, saving a copy of the whole document.
+            result = json.loads(response.read())
             parse_end = time.monotonic()
-            print(
-                f"Time to fetch & parse: {fetch_end - start} + {parse_end - fetch_end} = {parse_end - start} sec."
+            log(
+                "fetch",
+                logging.DEBUG,
+                fetch_sec=fetch_end - start,
+                parse_sec=parse_end - fetch_end,
             )
             return result
         else:
-            raise Exception(f"request failed with status {response.status}", flush=True)
+            raise Exception(f"request failed with status {response.status}")
+
 
+# Forecasts for all the locations we serve.
+#
+# Locations that round to the same LOCATION_GRID_DEGREES cell share one
+# forecast; the forecast for a few hundred meters away is the same, and we pay
+# per request.  When a cell's forecast is due, every other cell that's due
+# within REFRESH_SLACK_SEC is refreshed along with it, so all the cells refresh
+# in one cycle rather than each on its own schedule, in requests of up to
+# LOCATIONS_PER_REQUEST cells.  Whoever needed the refresh only waits for the
+# request with its own cell; the others are made in the background.  Anyone
+# who wants a cell that's due and being fetched waits for that fetch rather
+# than starting another.  A cell keeps its old forecast until a new one
+# arrives, so if a refresh it was only brought along on fails, it still has a
+# forecast until it's due.
+#
+# Only the parsed Forecast is kept; the decoded JSON document is garbage as
+# soon as parse() returns.  Forecasts are shared between threads, so treat them
+# as read only.
+LOCATION_GRID_DEGREES = 0.01
+REFRESH_SLACK_SEC = 30
 
-class QueryWithCaching:
-    def __init__(self, url, cache_time_in_sec):
-        self.url = url
-        self.cache_time_in_sec = cache_time_in_sec
-        self.last_time = None
-        self.last_data = None
 
-    def get(self):
-        current_time = time.monotonic()
-        if (
-            self.last_time is None
-            or current_time > self.last_time + self.cache_time_in_sec
-        ):
-            start = time.monotonic()
-            # There's evidence that we're running out of memory on the Raspberry
-            # Pi 3.  Free all this data before creating the new one.
-            self.last_data = None
-            print(f"About to fetch at {start - request_start}")
-            self.last_data = fetch_json(self.url)
-            end_time = time.monotonic()
-            print(
-                f"Got json, took {end_time - start}, request elapsed {end_time - request_start}"
+def grid_cell(latitude, longitude):
+    return (
+        round(latitude / LOCATION_GRID_DEGREES),
+        round(longitude / LOCATION_GRID_DEGREES),
+    )
+
+
+class ForecastCell:
+    def __init__(self, latitude, longitude, parse):
+        # Of the first location in the cell, so a single location gets exactly
+        # the forecast it asked for.
+        self.latitude = latitude
+        self.longitude = longitude
+        self.parse = parse
+        self.forecast = None
+        self.error = None
+        # time.monotonic() when the forecast needs fetching again.
+        self.due = 0
+        # A threading.Event while it's being fetched.
+        self.in_flight = None
+        # For PollingScheduler: what the last forecast looked like, how many
+        # fetches in a row it's stayed the same, and when a display last asked
+        # for this cell (time.monotonic()).
+        self.summary = None
+        self.unchanged = 0
+        self.last_display = None
+        # Failed fetches in a row.
+        self.failures = 0
+
+
+# How often to fetch each cell's forecast.  Rather than a fixed interval, we
+# spread a daily budget of requests evenly over what's left of the day, then:
+#
+# - poll faster when the forecast is changing a lot, or rain is on its way,
+#   or a display has been asking for it recently,
+# - back off when it keeps coming back the same, and overnight.
+#
+# Failed fetches count against the budget too, so they back off
+# exponentially.  If we do run out, we still poll every MAX_POLL_SEC rather
+# than leave the graphs frozen until midnight.
+#
+# So the budget goes on fresh data when it matters.  Because the even spread
+# is recomputed from what's left every time, speeding up now means backing off
+# a little later, and we don't run out before midnight.  See /debug/polling.
+MIN_POLL_SEC = 60
+MAX_POLL_SEC = 60 * 60
+BIG_TEMPERATURE_CHANGE = 2
+BIG_PRECIPITATION_CHANGE = 0.2
+RAIN_SOON_HOURS = 6
+DISPLAY_ACTIVE_SEC = 15 * 60
+
+
+def forecast_summary(forecast):
+    return [(p.start, p.temp, p.precipitation) for p in forecast.periods]
+
+
+# Where PollingScheduler keeps today's request count, so restarting doesn't
+# give us a fresh budget.  Without --archive-dir it only lives in memory, and
+# the budget is per process.
+POLLING_STATE_FILE = "polling.json"
+
+
+class PollingScheduler:
+    def __init__(self, daily_budget, state_path=None):
+        self.daily_budget = daily_budget
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        self.day = None
+        self.used_today = 0
+        self.used_total = 0
+        # cell -> the reasoning behind its current interval, for /debug/polling.
+        self.decisions = {}
+        self.load_state()
+
+    def load_state(self):
+        if self.state_path is None:
+            return
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            self.day = datetime.date.fromisoformat(state["day"])
+            self.used_today = state["used_today"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log("polling_state_error", logging.ERROR, path=self.state_path, error=e)
+
+    # Called with the lock held.
+    def save_state(self):
+        if self.state_path is None:
+            return
+        # Write it all then rename, so a crash part way through leaves the old
+        # count rather than a truncated file.
+        temp_path = self.state_path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(
+                    {"day": self.day.isoformat(), "used_today": self.used_today}, f
+                )
+            os.replace(temp_path, self.state_path)
+        except OSError as e:
+            log("polling_state_error", logging.ERROR, path=self.state_path, error=e)
+
+    def roll_over_day(self, now):
+        if now.date() != self.day:
+            self.day = now.date()
+            self.used_today = 0
+
+    def record_request(self):
+        with self.lock:
+            self.roll_over_day(datetime.datetime.now())
+            self.used_today += 1
+            self.used_total += 1
+            self.save_state()
+
+    # Seconds until cell should be fetched again, given the summary of the
+    # forecast we just got, when we make requests_per_cycle requests to refresh
+    # every cell.
+    def next_interval(self, cell, summary, requests_per_cycle):
+        now = datetime.datetime.now()
+        midnight = datetime.datetime.combine(
+            now.date() + timedelta(days=1), datetime.time()
+        )
+        seconds_left = (midnight - now).total_seconds()
+        with self.lock:
+            self.roll_over_day(now)
+            budget_left = self.daily_budget - self.used_today
+
+        reasons = []
+        if budget_left < requests_per_cycle:
+            interval = min(seconds_left, MAX_POLL_SEC)
+            reasons.append("out of budget")
+        else:
+            interval = seconds_left * requests_per_cycle / budget_left
+            reasons.append(f"{budget_left} requests left today")
+
+            temperature_change, precipitation_change = summary_change(
+                cell.summary, summary
             )
-            self.last_time = current_time
-        return self.last_data
+            if cell.summary is None:
+                pass
+            elif (
+                temperature_change >= BIG_TEMPERATURE_CHANGE
+                or precipitation_change >= BIG_PRECIPITATION_CHANGE
+            ):
+                interval /= 2
+                reasons.append(
+                    f"changing by {temperature_change:.1f} F, "
+                    f"{precipitation_change:.2f} precip"
+                )
+            elif summary == cell.summary:
+                cell.unchanged += 1
+                interval *= 2 ** min(cell.unchanged, 3)
+                reasons.append(f"unchanged {cell.unchanged} times")
+            if cell.summary is None or summary != cell.summary:
+                cell.unchanged = 0
+
+            if rain_coming(cell.summary, summary):
+                interval /= 2
+                reasons.append("rain coming")
+
+            if (
+                cell.last_display is not None
+                and time.monotonic() - cell.last_display < DISPLAY_ACTIVE_SEC
+            ):
+                interval *= 0.75
+                reasons.append("display active")
+
+            if now.hour >= 23 or now.hour < 5:
+                interval *= 3
+                reasons.append("overnight")
+
+            interval = min(max(interval, MIN_POLL_SEC), MAX_POLL_SEC)
+
+        self.decide(cell, interval, now, reasons)
+        return interval
+
+    # Seconds until cell should be fetched again after failing with error.
+    # Doubles with each failure in a row, and waits at least as long as the
+    # server asked, so an outage or an overloaded server doesn't get hammered or
+    # use up the day's budget.
+    def retry_interval(self, cell, error):
+        now = datetime.datetime.now()
+        cell.failures += 1
+        interval = min(FORECAST_RETRY_SEC * 2 ** (cell.failures - 1), MAX_POLL_SEC)
+        reasons = [f"failed {cell.failures} times in a row: {error}"]
+        headers = getattr(error, "headers", None)
+        retry_after = headers.get("Retry-After", "") if headers else ""
+        if retry_after.isdigit():
+            interval = max(interval, int(retry_after))
+            reasons.append(f"asked to wait {retry_after} sec")
+        self.decide(cell, interval, now, reasons)
+        return interval
+
+    def decide(self, cell, interval, now, reasons):
+        with self.lock:
+            self.decisions[(cell.latitude, cell.longitude)] = (
+                f"{interval:.0f} sec at {now:%H:%M:%S}: " + ", ".join(reasons)
+            )
+        log("poll_interval", logging.DEBUG, sec=interval, reasons=", ".join(reasons))
+
+    def report(self):
+        with self.lock:
+            lines = [
+                f"Budget: {self.daily_budget} requests/day, "
+                f"{self.used_today} used today, {self.used_total} since starting."
+            ]
+            for (latitude, longitude), decision in self.decisions.items():
+                lines.append(f"{latitude},{longitude}: {decision}")
+        return "\n".join(lines) + "\n"
+
+
+# Largest change in temperature and precipitation probability for any hour in
+# both forecasts.
+def summary_change(old, new):
+    if old is None:
+        return 0, 0
+    old_by_start = {start: (temp, precip) for start, temp, precip in old}
+    temperature_change = precipitation_change = 0
+    for start, temp, precip in new:
+        if start in old_by_start:
+            old_temp, old_precip = old_by_start[start]
+            temperature_change = max(temperature_change, abs(temp - old_temp))
+            precipitation_change = max(precipitation_change, abs(precip - old_precip))
+    return temperature_change, precipitation_change
+
+
+# Whether it's likely to rain in the next few hours, and more likely than last
+# time we looked.
+def rain_coming(old, new):
+    soon = max(precip for _, _, precip in new[:RAIN_SOON_HOURS])
+    if soon <= RAINING_THRESHOLD:
+        return False
+    if old is None:
+        return True
+    return soon > max(precip for _, _, precip in old[:RAIN_SOON_HOURS])
+
+
+class ForecastFetcher:
+    # fetch_batch(cells) returns the decoded JSON for each cell.
+    def __init__(self, fetch_batch, locations_per_request, poller):
+        self.fetch_batch = fetch_batch
+        self.locations_per_request = locations_per_request
+        self.poller = poller
+        self.lock = threading.Lock()
+        self.cells = {}
+
+    def add(self, latitude, longitude, parse):
+        key = grid_cell(latitude, longitude)
+        if key not in self.cells:
+            self.cells[key] = ForecastCell(latitude, longitude, parse)
+
+    def cell(self, latitude, longitude):
+        return self.cells[grid_cell(latitude, longitude)]
+
+    def get(self, latitude, longitude):
+        cell = self.cell(latitude, longitude)
+        with self.lock:
+            if time.monotonic() < cell.due:
+                if cell.error is not None:
+                    # Backing off, see PollingScheduler.retry_interval().  A
+                    # new exception each time, since raising the stored one
+                    # would keep adding to its traceback, from every thread.
+                    raise Exception(str(cell.error))
+                if cell.forecast is not None:
+                    return cell.forecast
+            if cell.in_flight is None:
+                batches = self.start_refresh(cell)
+            else:
+                batches = None
+                in_flight = cell.in_flight
+        if batches is None:
+            in_flight.wait()
+        else:
+            # Ours is first, so we only wait for it.
+            if len(batches) > 1:
+                threading.Thread(
+                    target=self.fetch_batches,
+                    args=(batches[1:],),
+                    name="forecast_fetch",
+                    daemon=True,
+                ).start()
+            self.fetch(batches[0])
+        with self.lock:
+            if cell.forecast is None or cell.error is not None:
+                # Or, rarely, someone started another refresh since.
+                raise Exception(str(cell.error or "Forecast is being refreshed"))
+            return cell.forecast
+
+    # Seconds until get() will fetch again.
+    def expires_in(self, latitude, longitude):
+        return max(0, self.cell(latitude, longitude).due - time.monotonic())
+
+    def display_polled(self, latitude, longitude):
+        self.cell(latitude, longitude).last_display = time.monotonic()
+
+    # Called with the lock held.
+    def start_refresh(self, cell):
+        now = time.monotonic()
+        due = [cell] + [
+            other
+            for other in self.cells.values()
+            if other is not cell
+            and other.in_flight is None
+            and other.due - now <= REFRESH_SLACK_SEC
+        ]
+        batches = [
+            due[i : i + self.locations_per_request]
+            for i in range(0, len(due), self.locations_per_request)
+        ]
+        for batch in batches:
+            in_flight = threading.Event()
+            for batch_cell in batch:
+                batch_cell.in_flight = in_flight
+        return batches
+
+    def fetch_batches(self, batches):
+        for batch in batches:
+            self.fetch(batch)
+
+    def fetch(self, batch):
+        start = time.monotonic()
+        # The whole batch shares one, see start_refresh().
+        in_flight = batch[0].in_flight
+        error = None
+        try:
+            self.poller.record_request()
+            try:
+                results = self.fetch_batch(batch)
+                # zip() would quietly drop the rest.
+                if len(results) != len(batch):
+                    raise Exception(
+                        f"Asked for {len(batch)} forecasts, got {len(results)}"
+                    )
+                forecasts = [cell.parse(result) for cell, result in zip(batch, results)]
+            except Exception as e:
+                forecasts = [None] * len(batch)
+                error = e
+            with self.lock:
+                requests_per_cycle = math.ceil(
+                    len(self.cells) / self.locations_per_request
+                )
+                for cell, forecast in zip(batch, forecasts):
+                    if error is None:
+                        summary = forecast_summary(forecast)
+                        cell.forecast = forecast
+                        cell.error = None
+                        cell.failures = 0
+                        cell.due = start + self.poller.next_interval(
+                            cell, summary, requests_per_cycle
+                        )
+                        cell.summary = summary
+                    elif cell.due <= start:
+                        # A cell that was only brought along early keeps its
+                        # forecast until it's due.
+                        cell.error = error
+                        cell.due = start + self.poller.retry_interval(cell, error)
+        finally:
+            # Whatever happened, don't leave anyone waiting on this batch, or
+            # stop the next get() from starting another fetch.
+            with self.lock:
+                for cell in batch:
+                    cell.in_flight = None
+            in_flight.set()
+        stats.count("forecast_requests")
+        log(
+            "forecast_fetched",
+            cells=len(batch),
+            sec=time.monotonic() - start,
+            error=error,
+        )
 
 
 # tomorrow = QueryWithCaching(
@@ -480,26 +1375,33 @@ def icon_to_precipitation(icon):
     return Precipitation.NONE
 
 
-visual_crossing = QueryWithCaching(
-    f"https://weather.visualcrossing.com/VisualCrossingWebServices/rest/services/timeline/{LATITUDE}%2C{LONGITUDE}?unitGroup=us&key={VISUAL_CROSSING_API_KEY}&contentType=json&iconSet=icons2",
-    2.5 * 60,
-)
-
-
-def get_forecast(latitude, longitude):
+# now, in seconds since the epoch, is for replaying a recorded forecast at a
+# later time; see batch_render().
+def build_forecast(result, now=None):
     # Visual Crossing documentation:
     # https://www.visualcrossing.com/resources/documentation/weather-api/timeline-weather-api/
 
-    result = visual_crossing.get()
-
     timezone = ZoneInfo(result["timezone"])
 
     today = result["days"][0]
     current = result["currentConditions"]
 
-    now = current["datetimeEpoch"]
-
-    isDayTime = current["sunriseEpoch"] <= now <= current["sunsetEpoch"]
+    if now is None:
+        now = current["datetimeEpoch"]
+        isDayTime = current["sunriseEpoch"] <= now <= current["sunsetEpoch"]
+    else:
+        # Days are 23 or 25 hours long when daylight saving changes.
+        day = next(
+            (
+                d
+                for d in result["days"]
+                if d["hours"][0]["datetimeEpoch"]
+                <= now
+                < d["hours"][-1]["datetimeEpoch"] + 60 * 60
+            ),
+            today,
+        )
+        isDayTime = day["sunriseEpoch"] <= now <= day["sunsetEpoch"]
 
     periods = []
     for day in result["days"]:
@@ -511,7 +1413,7 @@ def get_forecast(latitude, longitude):
                     Period(start, end, hour["temp"], hour["precipprob"] / 100.0)
                 )
 
-    print(f'precip: {current["precip"]}, precipprob: {current["precipprob"]}')
+    log("current_precip", precip=current["precip"], precipprob=current["precipprob"])
 
     return Forecast(
         timezone,
@@ -525,6 +1427,84 @@ def get_forecast(latitude, longitude):
     )
 
 
+def record_forecast(result, fetched):
+    path = os.path.join(args.record_forecasts, f"{fetched}.json.gz")
+    try:
+        with gzip.open(path, "wt") as f:
+            json.dump(result, f)
+    except OSError as e:
+        log("record_error", logging.ERROR, path=path, error=e)
+
+
+def build_and_archive_forecast(result):
+    forecast = build_forecast(result)
+    fetched = int(time.time())
+    if args.record_forecasts:
+        record_forecast(result, fetched)
+    archive_records(
+        forecast_archive,
+        [
+            (fetched, int(p.start.timestamp()) - fetched, p.temp, p.precipitation)
+            for p in forecast.long_range_forecast
+        ],
+    )
+    return forecast
+
+
+# Visual Crossing's Timeline API takes one location per request.  Its
+# timelinemulti variant takes several, separated by "|", and returns a
+# Timeline-style document for each, in the order we asked for them.
+VISUAL_CROSSING_LOCATIONS_PER_REQUEST = 10
+
+VISUAL_CROSSING_URL = (
+    "https://weather.visualcrossing.com/VisualCrossingWebServices/rest/services"
+)
+
+
+def fetch_visual_crossing(cells):
+    query = (
+        f"unitGroup=us&key={VISUAL_CROSSING_API_KEY}&contentType=json&iconSet=icons2"
+    )
+    if len(cells) == 1:
+        return [
+            fetch_json(
+                f"{VISUAL_CROSSING_URL}/timeline/{cells[0].latitude}%2C{cells[0].longitude}?{query}"
+            )
+        ]
+    locations = "%7C".join(f"{cell.latitude}%2C{cell.longitude}" for cell in cells)
+    return fetch_json(
+        f"{VISUAL_CROSSING_URL}/timelinemulti?locations={locations}&{query}"
+    )["locations"]
+
+
+# Batch rendering reads recorded forecasts instead.
+if not args.batch_render:
+    polling_scheduler = PollingScheduler(
+        args.daily_request_budget,
+        (
+            os.path.join(args.archive_dir, POLLING_STATE_FILE)
+            if args.archive_dir
+            else None
+        ),
+    )
+    visual_crossing = ForecastFetcher(
+        fetch_visual_crossing, VISUAL_CROSSING_LOCATIONS_PER_REQUEST, polling_scheduler
+    )
+    for location in locations.values():
+        # The archive is for comparing against the outdoor sensor, so it only
+        # wants the forecast for home.  Home is added first, so it owns its
+        # cell.
+        visual_crossing.add(
+            location.latitude,
+            location.longitude,
+            build_and_archive_forecast if location.name == HOME else build_forecast,
+        )
+
+
+def get_forecast(latitude, longitude):
+    return visual_crossing.get(latitude, longitude)
+
+
 def round_up_to_next_6_hours(input_datetime):
     # Calculate the number of hours to the next multiple of 6
     hours_to_next_6 = (6 - input_datetime.hour % 6) % 6
@@ -544,7 +1524,7 @@ def round_to_next_day(input_datetime):
         return truncated
 
 
-def plot_graph(periods, image, rect):
+def plot_graph(periods, layout, rect):
     # multiday = False
     multiday = periods[-1].end - periods[0].start > datetime.timedelta(hours=36)
     connected = len(periods) > 48
@@ -558,9 +1538,8 @@ def plot_graph(periods, image, rect):
     min_time = min(p.start for p in periods).timestamp()
     max_time = max(p.end for p in periods).timestamp()
 
-    draw = ImageDraw.Draw(image)
     font_size = (rect[3] - rect[1]) // 7
-    font = ImageFont.truetype("Pillow/Tests/fonts/DejaVuSans.ttf", font_size)
+    font = get_font(font_size)
 
     # This code for adjusting for text size is only approximate, so in practice,
     # when you change font size, you still need to adjust the rect parameter
@@ -599,15 +1578,15 @@ def plot_graph(periods, image, rect):
         precip_polygon += [(to_x(period.start), y), (to_x(period.end), y)]
 
     precip_polygon.append((graph_right, graph_bottom))
-    draw.polygon(precip_polygon, fill=PRECIPITATION_GREY)
+    layout.polygon(precip_polygon, PRECIPITATION_GREY)
 
     #####  Draw horizontal lines & labels for temperatures.
     # Should probably decide between every 10 degrees and every 5 degress based
     # on e.g. whatever gives closest to 5 lines.
     for temp in range(low_temp, high_temp + 1, 10):
         y = temp_to_y(temp)
-        draw.line((graph_left, y, graph_right, y), fill=128)
-        draw.text((graph_left - 3, y), str(temp), font=font, fill=0, anchor="rm")
+        layout.line((graph_left, y, graph_right, y), 128)
+        layout.text((graph_left - 3, y), str(temp), font_size, "rm")
 
     #####  Draw vertical lines & labels for times
     start_datetime = min(p.start for p in periods)
@@ -617,16 +1596,15 @@ def plot_graph(periods, image, rect):
 
         while this_datetime < end_datetime:
             x = to_x(this_datetime)
-            draw.line((x, graph_top, x, graph_bottom), fill=128)
+            layout.line((x, graph_top, x, graph_bottom), 128)
 
             text_datetime = this_datetime + timedelta(hours=12)
             if text_datetime < end_datetime:
-                draw.text(
+                layout.text(
                     (to_x(text_datetime), graph_bottom + GAP_BETWEEN_GRAPH_AND_LABELS),
                     this_datetime.strftime("%a"),
-                    font=font,
-                    fill=0,
-                    anchor="ma",
+                    font_size,
+                    "ma",
                 )
             this_datetime += timedelta(days=1)
     else:
@@ -636,7 +1614,7 @@ def plot_graph(periods, image, rect):
             x = to_x(this_datetime)
 
             if this_datetime.hour == 0:
-                draw.line((x, graph_top, x, graph_bottom), fill=128)
+                layout.line((x, graph_top, x, graph_bottom), 128)
 
             if this_datetime.hour == 12:
                 text = "noon"
@@ -645,12 +1623,11 @@ def plot_graph(periods, image, rect):
             else:
                 text = this_datetime.strftime("%-I%p").lower()
 
-            draw.text(
+            layout.text(
                 (x, graph_bottom + GAP_BETWEEN_GRAPH_AND_LABELS),
                 text,
-                font=font,
-                fill=0,
-                anchor="ma",
+                font_size,
+                "ma",
             )
 
             this_datetime += timedelta(hours=6)
@@ -658,7 +1635,7 @@ def plot_graph(periods, image, rect):
     # Draw the actual temperatures.
     if connected:
         xy = [(to_x(period.mid), temp_to_y(period.temp)) for period in periods]
-        draw.line(xy, fill=0, width=1)
+        layout.line(xy, 0)
     else:
         # prev_y = None
         for period in periods:
@@ -667,24 +1644,19 @@ def plot_graph(periods, image, rect):
             right = to_x(period.end)
 
             if period.start.hour == 15:
-                draw.rectangle(
-                    (left, graph_top, right, graph_bottom - 1),
-                    fill=AFTERNOON_GREY,
+                layout.rectangle(
+                    (left, graph_top, right, graph_bottom - 1), AFTERNOON_GREY
                 )
                 if period.precipitation > 0:
                     precipitation_y = (
                         period.precipitation * (graph_top - graph_bottom) + graph_bottom
                     )
-                    draw.rectangle(
+                    layout.rectangle(
                         (left, precipitation_y, right, graph_bottom - 1),
-                        fill=AFTERNOON_PRECIPITATION_GREY,
+                        AFTERNOON_PRECIPITATION_GREY,
                     )
 
-            draw.line(
-                (left, y, right, y),
-                fill=0,
-                width=3,
-            )
+            layout.line((left, y, right, y), 0, width=3)
             # if prev_y is not None:
             #     draw.line(
             #         (left, y, left, prev_y),
@@ -713,7 +1685,7 @@ def precipitation_from_weather(weather):
     return Precipitation.NONE
 
 
-def draw_icon(forecast, image, left, top):
+def draw_icon(forecast, layout):
     # I read somewhere that 20 mph is the threshold for "windy".
     windy = forecast.wind_speed > 20
 
@@ -732,56 +1704,191 @@ def draw_icon(forecast, image, left, top):
         forecast.precipitation,
         windy,
     )
-    icon = weather_icons[fname]
+    layout.icon(weather_icons[fname], ICON_BOX, centered=False)
 
-    image.paste(icon, box=(ICON_BOX[0], ICON_BOX[1]))
 
+# Coordinates as a flat tuple, x, y, x, y, ... whether given as that or as pairs.
+def flatten(xy):
+    if xy and isinstance(xy[0], tuple):
+        return tuple(c for point in xy for c in point)
+    return tuple(xy)
 
-# Paste an image into another image, centering it in the specified box.
-def paste_image(image, small_image, box):
-    image.paste(
-        small_image,
-        box=(
-            (box[0] + box[2] - small_image.size[0]) // 2,
-            (box[1] + box[3] - small_image.size[1]) // 2,
-        ),
-    )
 
+# What's on the screen, as a list of drawing operations in layout units.  All
+# the work of deciding what goes where (parsing the forecast, graph geometry,
+# picking icons) happens once, then rasterize() draws it for each panel size,
+# which only has to scale the coordinates.  Two layouts are equal if they'd
+# draw the same thing, so we can tell the screen hasn't changed without drawing
+# it.
+class Layout:
+    def __init__(self):
+        self.ops = []
+
+    def __eq__(self, other):
+        return isinstance(other, Layout) and self.ops == other.ops
+
+    def polygon(self, xy, fill):
+        self.ops.append(("polygon", flatten(xy), fill))
+
+    def line(self, xy, fill, width=1):
+        self.ops.append(("line", flatten(xy), fill, width))
+
+    def rectangle(self, box, fill):
+        self.ops.append(("rectangle", flatten(box), fill))
+
+    # Always black.
+    def text(self, xy, text, font_size, anchor):
+        self.ops.append(("text", flatten(xy), text, font_size, anchor))
+
+    # Centered in box, or at its top left.
+    def icon(self, fname, box, centered=True):
+        self.ops.append(("icon", fname, flatten(box), centered))
 
-def get_image():
-    image = Image.new("L", (800, 480), 255)
+
+fonts = {}
+
+
+def get_font(size):
+    font = fonts.get(size)
+    if font is None:
+        font = ImageFont.truetype("Pillow/Tests/fonts/DejaVuSans.ttf", size)
+        fonts[size] = font
+    return font
+
+
+def rasterize(layout, size):
+    image = Image.new("L", size, 255)
     draw = ImageDraw.Draw(image)
+    x_scale = size[0] / LAYOUT_WIDTH
+    y_scale = size[1] / LAYOUT_HEIGHT
+    # On a panel of a different shape, text and lines keep their proportions.
+    scale = min(x_scale, y_scale)
+
+    def scaled(xy):
+        if size == LAYOUT_SIZE:
+            return xy
+        return tuple(c * (y_scale if i % 2 else x_scale) for i, c in enumerate(xy))
+
+    for op, *params in layout.ops:
+        if op == "polygon":
+            xy, fill = params
+            draw.polygon(scaled(xy), fill=fill)
+        elif op == "line":
+            xy, fill, width = params
+            draw.line(scaled(xy), fill=fill, width=max(1, round(width * scale)))
+        elif op == "rectangle":
+            box, fill = params
+            draw.rectangle(scaled(box), fill=fill)
+        elif op == "text":
+            xy, text, font_size, anchor = params
+            font = get_font(max(1, round(font_size * scale)))
+            draw.text(scaled(xy), text, font=font, fill=0, anchor=anchor)
+        elif op == "icon":
+            fname, box, centered = params
+            left, top, right, bottom = (round(c) for c in scaled(box))
+            icon = scaled_icon(fname, right - left, bottom - top)
+            if centered:
+                left = (left + right - icon.size[0]) // 2
+                top = (top + bottom - icon.size[1]) // 2
+            image.paste(icon, box=(left, top))
+    return image
+
+
+# The earliest time, in time.time() seconds, at which get_layout() could lay out
+# something different, other than a new reading from the temperature sensor,
+# which LocalWeather reports when it happens.
+#
+# The forecast's periods, isDaytime and icon are all computed relative to its
+# own currentConditions, so hour boundaries and sunrise / sunset only show up on
+# the screen when we fetch a new forecast.
+#
+# reading is the sensor reading on the screen, or None.
+def next_change_time(location, forecast, reading, now):
+    expires_in = visual_crossing.expires_in(location.latitude, location.longitude)
+    if isinstance(forecast, Exception):
+        # When the fetcher will try again.  At least FORECAST_RETRY_SEC, in
+        # case the error didn't come from a fetch, so we don't spin.
+        expires_in = max(expires_in, FORECAST_RETRY_SEC)
+    candidates = [now.timestamp() + expires_in]
+
+    # Which period is the after school one depends on today's date.
+    tomorrow = now.date() + timedelta(days=1)
+    candidates.append(datetime.datetime.combine(tomorrow, datetime.time()).timestamp())
+
+    if reading is not None:
+        temperature_elapsed = sensor_elapsed(reading, now)
+        if temperature_elapsed < SENSOR_STALE_SEC:
+            boundary = SENSOR_STALE_SEC
+        elif temperature_elapsed < SENSOR_GIVE_UP_SEC:
+            # The "Nm" text changes whenever the minutes round to a new number.
+            minutes = math.floor(temperature_elapsed / 60 + 0.5) + 0.5
+            boundary = min(minutes * 60, SENSOR_GIVE_UP_SEC)
+        else:
+            boundary = None
+        if boundary is not None:
+            candidates.append(now.timestamp() + boundary - temperature_elapsed)
+
+    return min(candidates)
 
+
+# The forecast for location, or the Exception we got instead.  This is the part
+# of rendering that might wait on the network, so it happens before taking a
+# render slot.
+def current_forecast(location):
     try:
-        forecast = get_forecast(LATITUDE, LONGITUDE)
+        return get_forecast(location.latitude, location.longitude)
 
     except Exception as e:
-        print(e, flush=True)
-        forecast = e
+        log("forecast_error", logging.WARNING, error=e)
+        return e
+
+
+# Returns the layout and the time it's good until, see next_change_time().
+def get_layout(location, forecast):
+    now = datetime.datetime.now(datetime.timezone.utc).astimezone()
+    # The sensor is outside our house, so other locations go by the forecast.
+    if have_sensor and location.name == HOME:
+        reading = local_weather.snapshot()
+    else:
+        reading = None
+
+    layout = layout_dashboard(forecast, reading, now)
+    return layout, next_change_time(location, forecast, reading, now)
+
+
+# Seconds since the sensor's reading; 0 if there's no sensor.
+def sensor_elapsed(reading, now):
+    if reading is None:
+        return 0
+    return (now.replace(tzinfo=None) - reading.time).total_seconds()
+
+
+# Everything the dashboard shows comes from the arguments, so the batch
+# renderer can lay it out at any time it likes.  forecast may be the Exception
+# we got instead; reading is None if there's no sensor.
+def layout_dashboard(forecast, reading, now):
+    layout = Layout()
 
     ##### Get the current temperature.  Should probably be made into a function.
-    with local_weather.lock:
-        battery_ok = local_weather.battery_ok
-        current_temperature = local_weather.temperature
-        temperature_elapsed = (
-            datetime.datetime.now() - local_weather.time
-        ).total_seconds()
-
-    if not have_rtl_433:
+    battery_ok = reading is None or reading.battery_ok
+    temperature_elapsed = sensor_elapsed(reading, now)
+
+    if reading is not None:
+        current_temperature = reading.temperature
+    else:
         current_temperature = (
             0 if isinstance(forecast, Exception) else forecast.periods[0].temp
         )
-        temperature_elapsed = 0
 
     if current_temperature is not None:
-        if temperature_elapsed < 5 * 60:
+        if temperature_elapsed < SENSOR_STALE_SEC:
             text = str(round(current_temperature)) + "\N{DEGREE SIGN}"
             current_icon = get_clothing(
                 current_temperature,
                 isinstance(forecast, Exception) or forecast.is_raining,
             )
         else:
-            if temperature_elapsed < 100 * 60:
+            if temperature_elapsed < SENSOR_GIVE_UP_SEC:
                 text = str(round(temperature_elapsed / 60)) + "m"
             else:
                 text = "--"
@@ -791,7 +1898,6 @@ def get_image():
         text = "--"
 
     ##### Get the afternoon temperature when kids come home from school.
-    now = datetime.datetime.now(datetime.timezone.utc).astimezone()
     # This doesn't take into account daylight saving, and so will do the wrong
     # thing between midnight and two am, twice a year.  I can live with that.
     school = now.replace(hour=15, minute=40, second=0, microsecond=0)
@@ -815,112 +1921,929 @@ def get_image():
     ##### Now draw the two clothing icons
     if current_icon is None:
         if school_icon is not None:
-            paste_image(image, school_icon, AFTERNOON_CLOTHING_BOX)
+            layout.icon(school_icon, AFTERNOON_CLOTHING_BOX)
     else:
         if school_icon is None or current_icon == school_icon:
-            paste_image(image, current_icon, CLOTHING_BOX)
+            layout.icon(current_icon, CLOTHING_BOX)
         else:
-            paste_image(image, current_icon, MORNING_CLOTHING_BOX)
-            paste_image(image, school_icon, AFTERNOON_CLOTHING_BOX)
-
-    font = ImageFont.truetype("Pillow/Tests/fonts/DejaVuSans.ttf", 64)
+            layout.icon(current_icon, MORNING_CLOTHING_BOX)
+            layout.icon(school_icon, AFTERNOON_CLOTHING_BOX)
 
     if battery_ok:
-        draw.text(
+        layout.text(
             (
                 (TEMPERATURE_BOX[0] + TEMPERATURE_BOX[2]) // 2,
                 (TEMPERATURE_BOX[1] + TEMPERATURE_BOX[3]) // 2,
             ),
             text,
-            font=font,
-            fill=0,
-            anchor="mm",
+            64,
+            "mm",
         )
 
         if not isinstance(forecast, Exception):
-            draw_icon(forecast, image, 544, 25)
+            draw_icon(forecast, layout)
     else:
-        draw.multiline_text(
-            (image.size[0] - 128, 89), "Battery\nLow", font=font, fill=0, anchor="mm"
-        )
+        layout.text((LAYOUT_WIDTH - 128, 89), "Battery\nLow", 64, "mm")
     if isinstance(forecast, Exception):
         if str(forecast) != "HTTP Error 502: Bad Gateway":
-            font = ImageFont.truetype("Pillow/Tests/fonts/DejaVuSans.ttf", 32)
-            draw.text(
-                ((20 + 543) // 2, (25 + 460) // 2),
-                str(forecast),
-                font=font,
-                fill=0,
-                anchor="mm",
-            )
+            layout.text(((20 + 543) // 2, (25 + 460) // 2), str(forecast), 32, "mm")
     else:
         # Plot graph for next 24 hours.
-        plot_graph(forecast.periods, image, (20, 25, 543, 215))
+        plot_graph(forecast.periods, layout, (20, 25, 543, 215))
         # Plot graph for the coming week.
-        plot_graph(forecast.long_range_forecast, image, (20, 270, 543, 460))
+        plot_graph(forecast.long_range_forecast, layout, (20, 270, 543, 460))
 
-    return image
+    return layout
+
+
+# Frame encodings.  Displays pick one with a "format" query parameter
+# (/weather.bmp?format=rle) or an Accept header; BMP is the default, so existing
+# displays keep working.
+#
+# raw: packed 1 bit per pixel, rows top to bottom, most significant bit is the
+# leftmost pixel, 1 = white.  That's the panel's native layout: the BMP pixel
+# data without the header and without BMP's bottom-up row order.
+#
+# rle: the raw bytes compressed with PackBits (as in TIFF).  The dashboard is
+# mostly white, so the long runs of 0xff squash down to almost nothing, and less
+# data means less time with the radio on for battery powered panels.
+FRAME_FORMATS = {
+    "bmp": "image/bmp",
+    "raw": "application/x-weather-1bpp",
+    "rle": "application/x-weather-1bpp-packbits",
+    "png": "image/png",
+}
+
+# Three or more identical bytes are worth encoding as a run.
+PACKBITS_RUN = re.compile(rb"(.)\1{2,}", re.DOTALL)
+
+
+def packbits(data):
+    out = bytearray()
+
+    def literal(start, end):
+        for chunk_start in range(start, end, 128):
+            chunk = data[chunk_start : min(end, chunk_start + 128)]
+            out.append(len(chunk) - 1)
+            out.extend(chunk)
+
+    literal_start = 0
+    for match in PACKBITS_RUN.finditer(data):
+        literal(literal_start, match.start())
+        value = match.group(1)[0]
+        length = match.end() - match.start()
+        while length >= 3:
+            chunk = min(length, 128)
+            out.extend(((1 - chunk) & 0xFF, value))
+            length -= chunk
+        # Any one or two bytes left over go out with the next literal.
+        literal_start = match.end() - length
+    literal(literal_start, len(data))
+    return bytes(out)
+
+
+# A rendered, 1 bit per pixel frame, plus its encodings.  Each encoding is
+# computed the first time someone asks for it, then reused for every display
+# that asks for that format until the image changes.
+class Frame:
+    def __init__(self, image, raw):
+        self.image = image
+        self.raw = raw
+        self.lock = threading.Lock()
+        self.encoded = {}
+        # time.time() at which the screen might next change.
+        self.expires = 0
+
+    def encode(self, fmt):
+        with self.lock:
+            data = self.encoded.get(fmt)
+            if data is None:
+                if fmt == "raw":
+                    data = self.raw
+                elif fmt == "rle":
+                    data = packbits(self.raw)
+                else:
+                    buffer = io.BytesIO()
+                    self.image.save(buffer, format=fmt.upper(), optimize=True)
+                    data = buffer.getvalue()
+                data = memoryview(data)
+                self.encoded[fmt] = data
+        return data
+
+
+# One per location.  Lays out the next screen in the background at the moment
+# the current one expires, or when a sensor reading changes the screen, and
+# rasterizes it for each panel size displays have asked for, so displays get an
+# already rendered (and usually already encoded) frame.  It also tells displays
+# how long they can sleep before anything could change.
+#
+# Rendering is the expensive part of a request, so at most MAX_RENDERS happen at
+# once.  Requests that need one wait up to RENDER_QUEUE_SEC for a slot, and
+# by the time they get it, whoever had it has usually rendered what they need.
+class FrameScheduler:
+    def __init__(self, location):
+        self.location = location
+        self.condition = threading.Condition()
+        self.invalidated = False
+        # The last layout, when it expires, and the frames rasterized from it,
+        # by panel size.
+        self.layout = None
+        self.expires = 0
+        self.frames = {}
+        self.frames_lock = threading.Lock()
+
+    # Call with a render slot.  forecast is from current_forecast().
+    def render(self, forecast):
+        layout, expires = get_layout(self.location, forecast)
+        with self.frames_lock:
+            self.expires = expires
+            if layout == self.layout:
+                # Often nothing on the screen has changed since the last
+                # render, so keep the old frames and their encodings.
+                for frame in self.frames.values():
+                    frame.expires = expires
+                return
+            self.layout = layout
+            old_frames = self.frames
+            self.frames = {}
+        for size, old_frame in old_frames.items():
+            self.rasterize(size, old_frame)
+
+    # Call with a render slot.
+    def rasterize(self, size, old_frame=None):
+        with self.frames_lock:
+            layout = self.layout
+            expires = self.expires
+        image = rasterize(layout, size).convert("1")
+        raw = image.tobytes()
+        if old_frame is not None and old_frame.raw == raw:
+            frame = old_frame
+        else:
+            frame = Frame(image, raw)
+        frame.expires = expires
+        with self.frames_lock:
+            if layout is self.layout:
+                self.frames[size] = frame
+        return frame
+
+    def invalidate(self):
+        with self.condition:
+            self.invalidated = True
+            self.condition.notify()
+
+    # Returns None if we're too busy to render right now.
+    def get(self, size):
+        frame = self.frames.get(size)
+        if frame is not None and frame.expires > time.time():
+            return frame
+        # The background thread hasn't caught up yet, or no display has asked
+        # for this size before, so render it ourselves.  Any fetch happens
+        # first, so a slow forecast server doesn't hold up everyone waiting for
+        # a render slot.
+        if self.layout is None or self.expires <= time.time():
+            forecast = current_forecast(self.location)
+        else:
+            forecast = None
+        if not render_slots.acquire(timeout=RENDER_QUEUE_SEC):
+            stats.count("renders_shed")
+            return None
+        try:
+            if forecast is not None and (
+                self.layout is None or self.expires <= time.time()
+            ):
+                stats.count("renders_on_request")
+                self.render(forecast)
+            frame = self.frames.get(size)
+            if frame is None:
+                stats.count("rasterizations_on_request")
+                frame = self.rasterize(size)
+        finally:
+            render_slots.release()
+        return frame
+
+    def run(self):
+        while True:
+            try:
+                forecast = current_forecast(self.location)
+                with render_slots:
+                    stats.count("renders_scheduled")
+                    self.render(forecast)
+                timeout = self.expires - time.time()
+            except Exception:
+                log("frame_scheduler_exception", logging.ERROR, exc_info=True)
+                timeout = FORECAST_RETRY_SEC
+            with self.condition:
+                self.condition.wait_for(lambda: self.invalidated, max(timeout, 0))
+                self.invalidated = False
+
+
+MAX_RENDERS = 1
+RENDER_QUEUE_SEC = 10
+render_slots = threading.BoundedSemaphore(MAX_RENDERS)
+if not args.batch_render:
+    frame_schedulers = {
+        name: FrameScheduler(location) for name, location in locations.items()
+    }
+
+    # Only home shows the sensor.
+    local_weather.on_change = frame_schedulers[HOME].invalidate
+
+
+# Returns a key of FRAME_FORMATS, or None if the display asked for a format we
+# don't have.
+def choose_frame_format(query, accept):
+    requested = urllib.parse.parse_qs(query).get("format")
+    if requested:
+        fmt = requested[-1].lower()
+        return fmt if fmt in FRAME_FORMATS else None
+
+    if not accept:
+        return "bmp"
+
+    media_ranges = []
+    for index, item in enumerate(accept.split(",")):
+        media_type, _, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            media_ranges.append((-quality, index, media_type.strip().lower()))
+
+    for _, _, media_type in sorted(media_ranges):
+        for fmt, content_type in FRAME_FORMATS.items():
+            if media_type == content_type:
+                return fmt
+        if media_type in ("*/*", "image/*"):
+            return "bmp"
+
+    # Be lenient with clients that send an Accept header we don't understand.
+    return "bmp"
+
+
+# Like socket.sendall(), but for a list of buffers, so the headers and the image
+# go out in a single system call without first being copied into one buffer.
+def send_buffers(sock, buffers):
+    buffers = [memoryview(buffer) for buffer in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers:
+            buffers[0] = buffers[0][sent:]
+
+
+# Batch rendering: draw the dashboard at simulated times from recorded inputs,
+# e.g. to see what a layout change does over a week of real weather, or to check
+# that a refactoring doesn't change a single pixel.  Forecasts come from
+# --record-forecasts, sensor readings from the --archive-dir observations.  The
+# frames are drawn by a pool of worker processes, forked so they start with the
+# icons already loaded.
+
+# Frames per task handed to a worker.  Times in a task are consecutive, so each
+# worker mostly reuses the forecast it has already loaded.
+BATCH_CHUNK = 64
+
+
+# (fetch time, path) of each recorded forecast, oldest first.
+def list_recorded_forecasts(directory):
+    recorded = []
+    for name in os.listdir(directory):
+        if name.endswith(".json.gz"):
+            recorded.append((int(name.split(".")[0]), os.path.join(directory, name)))
+    recorded.sort()
+    return recorded
+
+
+# Includes the UTC offset, so the repeated hour when daylight saving ends
+# doesn't overwrite the first one.
+def batch_frame_name(now, size):
+    name = now.strftime("%Y%m%d-%H%M%S%z")
+    if size != LAYOUT_SIZE:
+        name += f"-{size[0]}x{size[1]}"
+    return name + ".png"
+
+
+# One per worker process.  observations is an archive.ArchiveReader, or None;
+# the workers share the parent's mapping.
+class BatchRenderer:
+    def __init__(self, recorded, observations, out_dir, compare_dir):
+        self.fetch_times = [fetched for fetched, _ in recorded]
+        self.paths = [path for _, path in recorded]
+        self.loaded_index = None
+        self.loaded = None
+        self.observations = observations
+        self.out_dir = out_dir
+        self.compare_dir = compare_dir
+
+    # The newest forecast fetched by time t, like the server would have had.
+    def forecast_at(self, t):
+        index = bisect.bisect_right(self.fetch_times, t) - 1
+        if index < 0:
+            return Exception("No forecast recorded yet")
+        try:
+            if index != self.loaded_index:
+                with gzip.open(self.paths[index], "rt") as f:
+                    self.loaded = json.load(f)
+                self.loaded_index = index
+            return build_forecast(self.loaded, t)
+        except Exception as e:
+            return e
+
+    def reading_at(self, t):
+        if self.observations is None:
+            return None
+        index = self.observations.search(t + 1) - 1
+        if index < 0:
+            return NO_SENSOR_READING
+        when, temperature, humidity = self.observations.record.unpack_from(
+            self.observations.view, index * self.observations.record.size
+        )
+        # The archive doesn't keep the battery state.
+        return SensorReading(
+            datetime.datetime.fromtimestamp(when), temperature, humidity, True
+        )
+
+    # Returns, for each panel size, (frame name, pixels different from the
+    # reference frame or None if not comparing, bounding box of the
+    # differences).
+    def render(self, t):
+        now = datetime.datetime.fromtimestamp(t).astimezone()
+        layout = layout_dashboard(self.forecast_at(t), self.reading_at(t), now)
+        return [self.rasterize(layout, now, size) for size in panel_sizes]
+
+    def rasterize(self, layout, now, size):
+        image = rasterize(layout, size).convert("1")
+        name = batch_frame_name(now, size)
+        image.save(os.path.join(self.out_dir, name), compress_level=1)
+
+        if self.compare_dir is None:
+            return name, None, None
+        try:
+            reference = Image.open(os.path.join(self.compare_dir, name)).convert("1")
+        except FileNotFoundError:
+            return name, None, "missing"
+        if reference.size != image.size:
+            return name, image.size[0] * image.size[1], "size"
+        diff = ImageChops.logical_xor(image, reference)
+        return name, diff.histogram()[255], diff.getbbox()
+
+
+batch_renderer = None
+
+
+def batch_worker_init(*renderer_args):
+    global batch_renderer
+    # Only what matters, from this many processes.
+    logger.setLevel(max(logger.level, logging.WARNING))
+    batch_renderer = BatchRenderer(*renderer_args)
+
+
+def batch_render_chunk(times):
+    return [result for t in times for result in batch_renderer.render(t)]
+
+
+def batch_render():
+    # Check everything here: if a worker's initializer fails, the pool just
+    # starts another one, forever.
+    try:
+        recorded = list_recorded_forecasts(args.batch_forecasts)
+    except OSError as e:
+        print(f"Can't read --batch-forecasts: {e}", file=sys.stderr)
+        sys.exit(1)
+    if not recorded:
+        print(f"No recorded forecasts in {args.batch_forecasts}", file=sys.stderr)
+        sys.exit(1)
+    observations = None
+    if args.archive_dir:
+        path = os.path.join(args.archive_dir, archive.OBSERVATIONS_FILE)
+        try:
+            observations = archive.ArchiveReader(path, archive.OBSERVATION_RECORD)
+        except OSError as e:
+            print(f"Can't read sensor readings from {path}: {e}", file=sys.stderr)
+            sys.exit(1)
+    start = int(args.batch_start.timestamp()) if args.batch_start else recorded[0][0]
+    end = int(args.batch_end.timestamp()) if args.batch_end else recorded[-1][0]
+    step = max(1, round(args.batch_step * 60))
+    times = list(range(start, end + 1, step))
+    chunks = [times[i : i + BATCH_CHUNK] for i in range(0, len(times), BATCH_CHUNK)]
+    os.makedirs(args.batch_render, exist_ok=True)
+
+    begin = time.perf_counter()
+    # Nothing at module level starts a thread in batch mode, so there's no
+    # lock for a worker to inherit half held.
+    with multiprocessing.get_context("fork").Pool(
+        args.batch_workers,
+        batch_worker_init,
+        (recorded, observations, args.batch_render, args.batch_compare),
+    ) as pool:
+        results = [
+            result
+            for chunk in pool.imap(batch_render_chunk, chunks)
+            for result in chunk
+        ]
+    elapsed = time.perf_counter() - begin
+
+    changed = None
+    if args.batch_compare:
+        changed = 0
+        with open(os.path.join(args.batch_render, "diff.csv"), "w") as f:
+            f.write("frame,pixels,bbox\n")
+            for name, pixels, bbox in results:
+                if pixels or bbox:
+                    changed += 1
+                    box = " ".join(map(str, bbox)) if isinstance(bbox, tuple) else bbox
+                    f.write(f"{name},{pixels if pixels is not None else ''},{box}\n")
+
+    log(
+        "batch_render",
+        frames=len(results),
+        sec=round(elapsed, 1),
+        per_minute=round(len(results) / elapsed * 60),
+        changed=changed,
+    )
+
+
+# The /debug pages are only for machines on the local network.
+def is_admin_client(host):
+    address = ipaddress.ip_address(host)
+    return address.is_loopback or address.is_private
+
+
+def read_proc_status(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return None
+
+
+memory_baseline_snapshot = None
+last_type_counts = collections.Counter()
+memory_report_lock = threading.Lock()
+
+
+# For keeping an eye on memory use over weeks of uptime.  Object counts per type
+# are compared to the previous report, and tracemalloc (with --tracemalloc)
+# to a snapshot taken at the first report, so a slow leak stands out.
+def memory_report():
+    global memory_baseline_snapshot, last_type_counts
+    lines = []
+    with memory_report_lock:
+        rss = read_proc_status("VmRSS")
+        if rss is None:
+            # ru_maxrss is in KB on Linux.
+            rss = f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss} kB (peak)"
+        lines.append(f"RSS: {rss}")
+        peak = read_proc_status("VmHWM")
+        if peak is not None:
+            lines.append(f"Peak RSS: {peak}")
+        lines.append(f"Threads: {threading.active_count()}")
+
+        gc.collect()
+        type_counts = collections.Counter(
+            type(obj).__qualname__ for obj in gc.get_objects()
+        )
+        lines.append("")
+        lines.append("Objects by type (change since last report):")
+        for name, count in type_counts.most_common(25):
+            lines.append(f"{count:10} {count - last_type_counts[name]:+8}  {name}")
+        for name in ["Forecast", "Period", "Frame"]:
+            lines.append(f"{type_counts[name]:10} {name}")
+        last_type_counts = type_counts
+
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append("")
+            lines.append(f"Traced: {current} bytes, peak {peak} bytes")
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)]
+            )
+            lines.append("Top allocations:")
+            for stat in snapshot.statistics("lineno")[:15]:
+                lines.append(f"  {stat}")
+            if memory_baseline_snapshot is None:
+                memory_baseline_snapshot = snapshot
+            else:
+                lines.append("Growth since first report:")
+                for stat in snapshot.compare_to(memory_baseline_snapshot, "lineno")[
+                    :15
+                ]:
+                    lines.append(f"  {stat}")
+        else:
+            lines.append("")
+            lines.append("Run with --tracemalloc for allocation sites.")
+    return "\n".join(lines) + "\n"
+
+
+# A sampling profiler, for finding out where the time goes on the live Pi.  Every
+# PROFILE_INTERVAL_SEC it grabs the stack of every thread (the rtl_433 reader,
+# the frame scheduler, the HTTP server's request threads), and when it's done it
+# writes two files to PROFILE_DIR:
+#
+#   weather-profile-TIME.folded: collapsed stacks, one per line with a count,
+#       for flamegraph.pl or speedscope.
+#   weather-profile-TIME.txt: the functions with the most samples.
+#
+# Start and stop it with SIGUSR2, or /debug/profile/start?seconds=N and
+# /debug/profile/stop.  /debug/profile shows the last summary.
+PROFILE_INTERVAL_SEC = 0.01
+PROFILE_DEFAULT_SEC = 30
+PROFILE_MAX_SEC = 10 * 60
+PROFILE_DIR = "/tmp"
+PROFILE_TOP_FUNCTIONS = 40
+
+
+def profile_frame_name(frame):
+    code = frame.f_code
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.summary = "No profile yet.\n"
+
+    # Returns False if it's already running.
+    def start(self, seconds):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+            self.stop_event.clear()
+            self.thread = threading.Thread(
+                target=self.run,
+                args=(min(seconds, PROFILE_MAX_SEC),),
+                name="profiler",
+                daemon=True,
+            )
+            self.thread.start()
+            return True
+
+    def stop(self):
+        self.stop_event.set()
+
+    def is_running(self):
+        thread = self.thread
+        return thread is not None and thread.is_alive()
+
+    def run(self, seconds):
+        log("profile_start", seconds=seconds)
+        me = threading.get_ident()
+        stacks = collections.Counter()
+        thread_names = {}
+        samples = 0
+        start = time.monotonic()
+        deadline = start + seconds
+        while time.monotonic() < deadline and not self.stop_event.wait(
+            PROFILE_INTERVAL_SEC
+        ):
+            frames = sys._current_frames()
+            if frames.keys() - thread_names.keys():
+                # Request threads are all called "Thread-N (...)", which would
+                # make every request its own tower in the flame graph.
+                thread_names = {
+                    thread.ident: re.sub(r"-\d+", "", thread.name)
+                    for thread in threading.enumerate()
+                }
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(profile_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(thread_names.get(ident, "unknown thread"))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+        self.write(stacks, samples, time.monotonic() - start)
+
+    def write(self, stacks, samples, elapsed):
+        # Self is samples where the function was running, total is samples where
+        # it was anywhere on the stack.
+        self_counts = collections.Counter()
+        total_counts = collections.Counter()
+        for stack, count in stacks.items():
+            functions = stack.split(";")[1:]
+            if functions:
+                self_counts[functions[-1]] += count
+            for function in set(functions):
+                total_counts[function] += count
+
+        lines = [
+            f"{samples} samples of {len(stacks)} distinct stacks over {elapsed:.1f} sec.",
+            "Threads waiting on I/O or locks show up too; look at total for the"
+            " render path, e.g. get_layout or rasterize.",
+            "",
+            f"{'self':>8} {'total':>8}  function",
+        ]
+        for function, count in self_counts.most_common(PROFILE_TOP_FUNCTIONS):
+            lines.append(f"{count:8} {total_counts[function]:8}  {function}")
+
+        base = os.path.join(
+            PROFILE_DIR,
+            f"weather-profile-{datetime.datetime.now():%Y%m%d-%H%M%S}",
+        )
+        try:
+            with open(base + ".folded", "w") as f:
+                for stack, count in stacks.items():
+                    f.write(f"{stack} {count}\n")
+            with open(base + ".txt", "w") as f:
+                f.write("\n".join(lines) + "\n")
+            lines.insert(0, f"Written to {base}.folded and {base}.txt")
+        except OSError as e:
+            lines.insert(0, f"Couldn't write {base}: {e}")
+        self.summary = "\n".join(lines) + "\n"
+        log("profile_done", samples=samples, stacks=len(stacks), path=base)
+
+
+profiler = SamplingProfiler()
+
+
+# The SIGUSR2 handler runs on the main thread, which could be in the middle of
+# starting a request's thread, holding a lock that starting the profiler's
+# thread needs too.  So all it does is write a byte to a pipe, and this thread
+# does the toggling.
+def profiler_signal_thread(read_fd):
+    while True:
+        os.read(read_fd, 1)
+        if not profiler.start(PROFILE_DEFAULT_SEC):
+            profiler.stop()
+
+
+def profiler_signal(sig, frame):
+    try:
+        os.write(profiler_signal_fd, b"\0")
+    except BlockingIOError:
+        # Plenty of toggles already waiting.
+        pass
+
+
+if not args.batch_render:
+    profiler_signal_read_fd, profiler_signal_fd = os.pipe()
+    os.set_blocking(profiler_signal_fd, False)
+    threading.Thread(
+        target=profiler_signal_thread,
+        args=(profiler_signal_read_fd,),
+        name="profiler_signal",
+        daemon=True,
+    ).start()
+    signal.signal(signal.SIGUSR2, profiler_signal)
+
+
+# Anything that's not a display or us is a bot poking at the port, so give it
+# a canned answer in a single write, and don't let it hog threads or CPU.
+def canned_response(status, extra_headers, html):
+    body = (
+        f"<html><head><title>{status}</title></head><body><p>{html}</p></body></html>"
+    )
+    headers = [f"HTTP/1.0 {status}", "Content-Type: text/html"] + extra_headers
+    headers.append(f"Content-Length: {len(body)}")
+    return ("\r\n".join(headers) + "\r\n\r\n" + body).encode()
+
+
+NOT_FOUND_RESPONSE = canned_response("404 Not Found", [], "Don't hack me go away.")
+BUSY_RESPONSE = canned_response(
+    "503 Service Unavailable", [f"Retry-After: {RENDER_QUEUE_SEC}"], "Busy, try again."
+)
+
+# Per client token buckets: each connection takes a token, and a client gets
+# CLIENT_REQUESTS_PER_SEC tokens back per second, up to CLIENT_BURST.  Clients
+# on the local network, i.e. the displays, aren't limited.
+CLIENT_REQUESTS_PER_SEC = 0.5
+CLIENT_BURST = 10
+MAX_TRACKED_CLIENTS = 1024
+
+# Connections from outside the local network get at most this many threads.
+MAX_REMOTE_CONNECTIONS = 8
+
+
+class TokenBuckets:
+    def __init__(self, rate, burst, max_clients):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        # host -> (tokens, time.monotonic() when last updated)
+        self.buckets = {}
+
+    def take(self, host):
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[host] = (tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.prune(now)
+            return allowed
+
+    def prune(self, now):
+        # Forget clients whose buckets have filled back up.
+        self.buckets = {
+            host: (tokens, last)
+            for host, (tokens, last) in self.buckets.items()
+            if tokens + (now - last) * self.rate < self.burst
+        }
+        if len(self.buckets) > self.max_clients:
+            # Lots of clients at once.  Forgive them all rather than grow.
+            self.buckets = {}
+
+
+# Decides whether to accept each connection before ThreadingHTTPServer starts a
+# thread for it.
+class AdmissionHTTPServer(ThreadingHTTPServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = TokenBuckets(
+            CLIENT_REQUESTS_PER_SEC, CLIENT_BURST, MAX_TRACKED_CLIENTS
+        )
+        self.remote_lock = threading.Lock()
+        self.remote_connections = set()
+
+    def verify_request(self, request, client_address):
+        host = client_address[0]
+        if is_admin_client(host):
+            stats.count("connections_local")
+            return True
+        if not self.buckets.take(host):
+            stats.count("connections_rate_limited")
+            return False
+        with self.remote_lock:
+            if len(self.remote_connections) >= MAX_REMOTE_CONNECTIONS:
+                stats.count("connections_over_limit")
+                return False
+            self.remote_connections.add(request)
+        stats.count("connections_remote")
+        return True
+
+    def shutdown_request(self, request):
+        with self.remote_lock:
+            self.remote_connections.discard(request)
+        super().shutdown_request(request)
 
 
 class WeatherHTTPRequestHandler(BaseHTTPRequestHandler):
+    # So a client that connects and says nothing doesn't keep a thread forever.
+    timeout = 15
+
+    # The default prints a line per request; we just count them.
+    def log_request(self, code="-", size="-"):
+        stats.count(f"status_{getattr(code, 'value', code)}")
+
+    def log_error(self, format, *args):
+        stats.count("bad_requests")
+
+    def send_canned(self, response):
+        self.log_request(int(response[9:12]))
+        self.wfile.write(response)
+        self.close_connection = True
+
+    def send_body(self, content_type, body):
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        # Rather than end_headers(), which writes the headers on their own, send
+        # them together with the body.
+        self._headers_buffer.append(b"\r\n")
+        headers = b"".join(self._headers_buffer)
+        self._headers_buffer = []
+        send_buffers(self.connection, [headers, body])
+
     def do_GET(self):
-        global request_start
         request_start = time.monotonic()
         try:
-            if self.path == "/weather.bmp":
-                print(
-                    "Someone wants to know whether the weather is wetter.", flush=True
+            url = urllib.parse.urlsplit(self.path)
+            if url.path in ("/weather.bmp", "/weather"):
+                fmt = choose_frame_format(url.query, self.headers.get("Accept"))
+                if fmt is None:
+                    self.send_response(406)
+                    self.send_body(
+                        "text/plain", b"Formats: " + ", ".join(FRAME_FORMATS).encode()
+                    )
+                    return
+                query = urllib.parse.parse_qs(url.query)
+                frame_scheduler = frame_schedulers.get(
+                    query.get("location", [HOME])[-1]
+                )
+                size = (
+                    parse_panel_size(query["size"][-1])
+                    if "size" in query
+                    else LAYOUT_SIZE
                 )
-                for thread in threading.enumerate():
-                    print(f"{thread}, native_id={thread.native_id}")
-                print(
-                    f"Number of active threads in process: {threading.active_count()}"
+                if frame_scheduler is None or size not in panel_sizes:
+                    self.send_canned(NOT_FOUND_RESPONSE)
+                    return
+                visual_crossing.display_polled(
+                    frame_scheduler.location.latitude,
+                    frame_scheduler.location.longitude,
                 )
-                image = get_image().convert("1")
-                print(f"Got image after {time.monotonic() - request_start} sec")
+                frame = frame_scheduler.get(size)
+                if frame is None:
+                    self.send_canned(BUSY_RESPONSE)
+                    return
+                body = frame.encode(fmt)
+                got_frame = time.monotonic()
+                # Tell the display how long it can sleep.
+                max_age = max(1, math.ceil(frame.expires - time.time()))
                 self.send_response(200)
-                self.send_header("Content-type", "image/bmp")
-                self.end_headers()
-                # image = Image.open("/tmp/bad.bmp")
-                # image.save(self.wfile, format="BMP")
-
-                print(f"Headers sent at {time.monotonic() - request_start} sec.")
-
-                image.save(self.wfile, format="BMP")
-
-                print(
-                    f"Done sending image response in {time.monotonic() - request_start} sec.",
-                    flush=True,
+                self.send_header("Cache-Control", f"max-age={max_age}")
+                self.send_header("Retry-After", str(max_age))
+                self.send_body(FRAME_FORMATS[fmt], body)
+
+                log(
+                    "frame",
+                    fmt=fmt,
+                    size=f"{size[0]}x{size[1]}",
+                    bytes=len(body),
+                    render_sec=got_frame - request_start,
+                    sec=time.monotonic() - request_start,
                 )
                 if False:
                     with open(f"/tmp/weather-{datetime.datetime.now()}.bmp", "wb") as f:
-                        image.save(f, format="BMP")
+                        frame.image.save(f, format="BMP")
+            elif url.path.startswith("/debug/") and is_admin_client(
+                self.client_address[0]
+            ):
+                self.do_debug(url)
             else:
-                print("Got some other GET request.", flush=True)
-                self.send_response(404)
-                self.send_header("Content-type", "text/html")
-                self.end_headers()
-                self.wfile.write(b"<html><head><title>Not found.</title></head>")
-                self.wfile.write(b"<body><p>Don't hack me go away.</p>")
-                self.wfile.write(b"</body></html>")
+                self.send_canned(NOT_FOUND_RESPONSE)
         except Exception:
-            print("Got exception!", flush=True)
+            log("request_exception", logging.ERROR, path=self.path, exc_info=True)
             self.send_response(500)
             self.send_header("Content-type", "text/html")
             self.end_headers()
             self.wfile.write(b"<html><head><title>Python Exception.</title></head>")
             self.wfile.write(b"<body><p>Python code threw an exception.</p>")
-            print(traceback.format_exc(), flush=True)
             # self.wfile.write(traceback.format_exc()) Convert to binary?
             self.wfile.write(b"</body></html>")
 
+    def do_debug(self, url):
+        if url.path == "/debug/memory":
+            text = memory_report()
+        elif url.path == "/debug/stats":
+            text = "".join(
+                f"{name} {count}\n" for name, count in sorted(stats.snapshot().items())
+            )
+        elif url.path == "/debug/profile/start":
+            try:
+                seconds = float(
+                    urllib.parse.parse_qs(url.query).get(
+                        "seconds", [PROFILE_DEFAULT_SEC]
+                    )[-1]
+                )
+            except ValueError:
+                seconds = PROFILE_DEFAULT_SEC
+            if profiler.start(seconds):
+                text = f"Profiling for {min(seconds, PROFILE_MAX_SEC)} sec.\n"
+            else:
+                text = "Already profiling.\n"
+        elif url.path == "/debug/profile/stop":
+            profiler.stop()
+            text = "Stopping.\n"
+        elif url.path == "/debug/profile":
+            text = (
+                "Profiling now.\n" if profiler.is_running() else ""
+            ) + profiler.summary
+        elif url.path == "/debug/polling":
+            text = polling_scheduler.report()
+        elif url.path == "/debug/threads":
+            text = "".join(
+                f"{thread}, native_id={thread.native_id}\n"
+                for thread in threading.enumerate()
+            )
+        else:
+            self.send_canned(NOT_FOUND_RESPONSE)
+            return
+        self.send_response(200)
+        self.send_body("text/plain", text.encode())
+
 
 def run_http_server():
+    for name, frame_scheduler in frame_schedulers.items():
+        threading.Thread(
+            target=frame_scheduler.run, name=f"frame_scheduler {name}", daemon=True
+        ).start()
     server_address = ("", 8998)
-    print("Launching server.", flush=True)
-    httpd = ThreadingHTTPServer(server_address, WeatherHTTPRequestHandler)
-    print("Listening.", flush=True)
+    log("launching_server")
+    httpd = AdmissionHTTPServer(server_address, WeatherHTTPRequestHandler)
+    log("listening")
     httpd.serve_forever()
 
 
-run_http_server()
+if args.batch_render:
+    batch_render()
+else:
+    run_http_server()